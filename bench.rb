@@ -10,6 +10,7 @@ num = ARGV[0] ? ARGV[0].to_i : 10
 repeats = ARGV[1] ? ARGV[1].to_i : 1
 
 code = File.read('test/test_pygments.rb') * repeats
+snippet = "def foo(bar):\n    return bar * 2\n"
 
 puts "Benchmarking....\n"
 puts "Size: #{code.bytesize} bytes\n"
@@ -25,4 +26,38 @@ Benchmark.bm(40) do |x|
   x.report('pygments popen (process already started 2) ') do
     (1..num).each { |_i|; Pygments.highlight(code, lexer: 'python') }
   end
+  x.report('pygments popen (batch)                     ') do
+    Pygments.highlight_many(Array.new(num) { [code, { lexer: 'python' }] })
+  end
+  x.report('pygments popen (small snippets)            ') do
+    (1..num * 10).each { |_i|; Pygments.highlight(snippet, lexer: 'python') }
+  end
+  x.report('pygments popen (small snippets, batch)     ') do
+    Pygments.highlight_many(Array.new(num * 10) { [snippet, { lexer: 'python' }] })
+  end
+end
+
+puts "\nTime to first highlight....\n"
+
+Benchmark.bm(40) do |x|
+  x.report('new process                                ') do
+    (1..num).each do |_i|
+      popen = Pygments::Popen.new
+      popen.highlight(snippet, lexer: 'python')
+      popen.stop 'Benchmark'
+    end
+  end
+
+  unless Gem.win_platform?
+    zygote = Pygments::Zygote.new(lexers: %w[python])
+    zygote.start
+    x.report('process forked from zygote                 ') do
+      (1..num).each do |_i|
+        popen = Pygments::Popen.new(zygote: zygote)
+        popen.highlight(snippet, lexer: 'python')
+        popen.stop 'Benchmark'
+      end
+    end
+    zygote.stop 'Benchmark'
+  end
 end
@@ -0,0 +1,188 @@
+# frozen_string_literal: true
+
+# Benchmarks the whole mentos pipeline and prints the results as JSON, so that
+# runs can be compared to catch regressions:
+#
+#   ruby bench/suite.rb [iterations] > results.json
+#
+# Progress goes to stderr.
+
+require_relative '../lib/pygments'
+require 'json'
+
+ITERATIONS = ARGV[0] ? ARGV[0].to_i : 5
+
+ROOT = File.join(__dir__, '..')
+
+SAMPLES = {
+  'ruby' => File.read(File.join(ROOT, 'lib', 'pygments', 'popen.rb')),
+  'python' => File.read(File.join(ROOT, 'lib', 'pygments', 'mentos.py')),
+  'json' => File.read(File.join(ROOT, 'lib', 'pygments', 'lexers.json'))[0, 16 * 1024],
+  'c' => <<~C,
+    #include <stdio.h>
+
+    static int fib(int n) {
+        return n < 2 ? n : fib(n - 1) + fib(n - 2);
+    }
+
+    int main(void) {
+        for (int i = 0; i < 10; i++) printf("%d\\n", fib(i));
+        return 0;
+    }
+  C
+  'javascript' => <<~JS,
+    const fib = (n) => (n < 2 ? n : fib(n - 1) + fib(n - 2));
+    export function render(items) {
+      return items.map((item, i) => `<li data-i="${i}">${item.name}</li>`).join('');
+    }
+    document.addEventListener('DOMContentLoaded', () => console.log(fib(10)));
+  JS
+  'html' => <<~HTML,
+    <!DOCTYPE html>
+    <html lang="en">
+      <head><meta charset="utf-8"><title>Benchmark</title></head>
+      <body class="main"><p id="intro">Hello, <em>world</em>!</p><a href="/x">link</a></body>
+    </html>
+  HTML
+  'sql' => <<~SQL,
+    SELECT u.id, u.name, COUNT(o.id) AS orders
+    FROM users u LEFT JOIN orders o ON o.user_id = u.id
+    WHERE u.created_at > '2020-01-01'
+    GROUP BY u.id, u.name HAVING COUNT(o.id) > 3 ORDER BY orders DESC;
+  SQL
+  'yaml' => <<~YAML,
+    name: CI
+    on: [push, pull_request]
+    jobs:
+      test:
+        runs-on: ubuntu-latest
+        steps:
+          - uses: actions/checkout@v6
+          - run: bundle exec rake test
+  YAML
+  'go' => <<~GO,
+    package main
+
+    import "fmt"
+
+    func fib(n int) int {
+    	if n < 2 {
+    		return n
+    	}
+    	return fib(n-1) + fib(n-2)
+    }
+
+    func main() { fmt.Println(fib(10)) }
+  GO
+  'css' => <<~CSS
+    .highlight .err { color: #a61717; background-color: #e3d2d2 }
+    body > main article:first-child { margin: 0 auto; max-width: 72em; }
+    @media (max-width: 600px) { .sidebar { display: none !important; } }
+  CSS
+}.freeze
+
+SIZES = [1024, 16 * 1024, 256 * 1024].freeze
+FORMATTERS = %w[html terminal256 latex].freeze
+
+# @return [String] sample repeated or cut to about size bytes
+def sized(sample, size)
+  (sample * ((size / sample.bytesize) + 1)).byteslice(0, size).scrub('')
+end
+
+def now
+  Process.clock_gettime(Process::CLOCK_MONOTONIC)
+end
+
+# Python-side timings of the requests made while the block runs, summed up.
+def python_timings
+  totals = Hash.new(0.0)
+  subscriber = Pygments.subscribe do |event, payload|
+    next unless event == :mentos && payload[:python]
+
+    payload[:python].each { |k, v| totals[k] += v }
+  end
+  yield
+  totals
+ensure
+  Pygments.unsubscribe(subscriber)
+end
+
+# Run the block ITERATIONS times and describe how long it took. Wall-clock
+# times come from runs without subscribers, so that they measure the usual
+# path; Python-side timings come from one more, instrumented run.
+def measure(name, **attrs)
+  warn "#{name} #{attrs.map { |k, v| "#{k}=#{v}" }.join(' ')}"
+  times = ITERATIONS.times.map do
+    started_at = now
+    yield
+    now - started_at
+  end
+  python = python_timings { yield }
+
+  {
+    benchmark: name,
+    **attrs,
+    iterations: ITERATIONS,
+    mean_ms: (times.sum / times.size * 1000).round(3),
+    min_ms: (times.min * 1000).round(3),
+    max_ms: (times.max * 1000).round(3),
+    python_ms: python.transform_values { |v| (v * 1000).round(3) }
+  }
+end
+
+results = []
+
+# Warm up the process and the lexers we are going to use.
+SAMPLES.each_key { |lexer| Pygments.highlight('1', lexer: lexer) }
+
+SAMPLES.each do |lexer, sample|
+  SIZES.each do |size|
+    code = sized(sample, size)
+    results << measure('highlight', lexer: lexer, bytes: code.bytesize, formatter: 'html') do
+      Pygments.highlight(code, lexer: lexer)
+    end
+  end
+end
+
+FORMATTERS.each do |formatter|
+  code = sized(SAMPLES['python'], 16 * 1024)
+  results << measure('highlight', lexer: 'python', bytes: code.bytesize, formatter: formatter) do
+    Pygments.highlight(code, lexer: 'python', formatter: formatter)
+  end
+end
+
+snippets = SAMPLES.map { |lexer, sample| [sized(sample, 1024), { lexer: lexer }] } * 10
+results << measure('single', snippets: snippets.size, bytes: snippets.sum { |code, _| code.bytesize }) do
+  snippets.each { |code, opts| Pygments.highlight(code, opts) }
+end
+results << measure('batch', snippets: snippets.size, bytes: snippets.sum { |code, _| code.bytesize }) do
+  Pygments.highlight_many(snippets)
+end
+
+code = sized(SAMPLES['python'], 1024)
+results << measure('cold', lexer: 'python', bytes: code.bytesize) do
+  popen = Pygments::Popen.new
+  popen.highlight(code, lexer: 'python')
+  popen.stop 'Benchmark'
+end
+results << measure('warm', lexer: 'python', bytes: code.bytesize) do
+  Pygments.highlight(code, lexer: 'python')
+end
+
+unless Gem.win_platform?
+  zygote = Pygments::Zygote.new(lexers: %w[python])
+  zygote.start
+  results << measure('zygote', lexer: 'python', bytes: code.bytesize) do
+    popen = Pygments::Popen.new(zygote: zygote)
+    popen.highlight(code, lexer: 'python')
+    popen.stop 'Benchmark'
+  end
+  zygote.stop 'Benchmark'
+end
+
+puts JSON.pretty_generate(
+  ruby: RUBY_DESCRIPTION,
+  pygments: Pygments.pygments_version,
+  iterations: ITERATIONS,
+  results: results
+)
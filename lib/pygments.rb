@@ -2,20 +2,90 @@
 
 require 'forwardable'
 
+require_relative 'pygments/cache'
 require_relative 'pygments/lexer'
 require_relative 'pygments/popen'
+require_relative 'pygments/pool'
+require_relative 'pygments/zygote'
 
 module Pygments
+  @subscribers = [].freeze
+  @subscribers_mutex = Mutex.new
+
   class << self
     extend Forwardable
 
+    # Subscribe to timings of pygments.rb internals. The block is called with
+    # an event name and a payload hash:
+    #
+    # :mentos   - a request to Python, with :method, :pid, :serialize, :write,
+    #             :response and :total times in seconds, :python timings
+    #             reported by mentos, and :error if the request failed
+    # :checkout - a Pygments::Pool checkout, with :wait time in seconds
+    #
+    # Subscribers are called on the thread that made the call.
+    #
+    # @return [Proc] the subscriber, to pass to #unsubscribe
+    def subscribe(&block)
+      @subscribers_mutex.synchronize { @subscribers = [*@subscribers, block].freeze }
+      block
+    end
+
+    # @param subscriber [Proc]
+    def unsubscribe(subscriber)
+      @subscribers_mutex.synchronize { @subscribers = (@subscribers - [subscriber]).freeze }
+    end
+
+    # @return [Boolean] true if anybody subscribed to timings
+    def instrumenting?
+      !@subscribers.empty?
+    end
+
+    # Notify subscribers of an event.
+    # @param event [Symbol]
+    # @param payload [Hash]
+    def instrument(event, payload)
+      @subscribers.each { |subscriber| subscriber.call(event, payload) }
+    end
+
     def lexers
       LexerCache.instance.raw_lexers
     end
 
+    # Set an engine shared by all threads, e.g. a Pygments::Pool.
+    # When unset, each thread gets its own Pygments::Popen.
+    attr_writer :engine
+
+    # Set a Pygments::Zygote to fork the per-thread processes from.
+    attr_accessor :zygote
+
     def engine
-      Thread.current.thread_variable_get(:pygments_engine) ||
-        Thread.current.thread_variable_set(:pygments_engine, Pygments::Popen.new)
+      @engine ||
+        Thread.current.thread_variable_get(:pygments_engine) ||
+        Thread.current.thread_variable_set(:pygments_engine, Pygments::Popen.new(zygote: zygote))
+    end
+
+    # Set a Pygments::Cache to reuse results of #highlight for identical input.
+    attr_accessor :cache
+
+    # Highlight code, see Popen#highlight.
+    # Results come from #cache when one is set.
+    def highlight(code, opts = {})
+      return engine.highlight(code, opts) if cache.nil?
+
+      cache.fetch(code, opts) { engine.highlight(code, opts) }
+    end
+
+    # Version of the Pygments that mentos imports first, read from its sources
+    # without starting Python.
+    #
+    # @return [String, nil] nil if mentos would import Pygments from elsewhere
+    def local_pygments_version
+      path = ENV.fetch('PYGMENTS_PATH', File.join(__dir__, '..', 'vendor', 'pygments-main'))
+      init = File.join(path, 'pygments', '__init__.py')
+      return nil unless File.exist?(init)
+
+      File.read(init)[/^__version__ = ['"](.+?)['"]/, 1]
     end
 
     def lexer_name_for(*args)
@@ -30,8 +100,10 @@ module Pygments
                    :styles,
                    :css,
                    :lexer_names_for,
-                   :highlight,
+                   :highlight_stream,
+                   :highlight_many,
                    :start,
-                   :pygments_version
+                   :pygments_version,
+                   :stats
   end
 end
@@ -0,0 +1,198 @@
+# frozen_string_literal: true
+
+require 'digest'
+require 'fileutils'
+require 'json'
+
+module Pygments
+  # A content-addressed cache of highlighted code.
+  #
+  # Results are keyed by a digest of the code, the normalized highlight options
+  # and the Pygments version, so repeated calls with identical input skip the
+  # round trip to Python altogether:
+  #
+  #   Pygments.cache = Pygments::Cache.new
+  #   Pygments.cache = Pygments::Cache.new(store: Pygments::Cache::FileStore.new('tmp/pygments'))
+  #
+  # A store is any object that responds to #read(key) and #write(key, value).
+  class Cache
+    # An in-memory store that evicts least recently used entries once the
+    # total size of cached results exceeds a limit.
+    class MemoryStore
+      # @return [Integer] limit on the total size of cached results, in bytes
+      attr_reader :max_bytes
+      # @return [Integer] total size of cached results, in bytes
+      attr_reader :bytesize
+
+      # @param max_bytes [Integer]
+      def initialize(max_bytes: 32 * 1024 * 1024)
+        @max_bytes = max_bytes
+        @bytesize = 0
+        @entries = {}
+        @mutex = Mutex.new
+      end
+
+      # @param key [String]
+      # @return [String, nil]
+      def read(key)
+        @mutex.synchronize do
+          value = @entries.delete(key)
+          # Hashes keep insertion order, so re-inserting marks the entry as recently used.
+          @entries[key] = value unless value.nil?
+          value
+        end
+      end
+
+      # @param key [String]
+      # @param value [String]
+      def write(key, value)
+        return if value.bytesize > @max_bytes
+
+        @mutex.synchronize do
+          old = @entries.delete(key)
+          @bytesize -= old.bytesize unless old.nil?
+          @entries[key] = value
+          @bytesize += value.bytesize
+
+          while @bytesize > @max_bytes
+            _, evicted = @entries.shift
+            @bytesize -= evicted.bytesize
+          end
+        end
+      end
+
+      # @return [Integer] number of cached results
+      def size
+        @mutex.synchronize { @entries.size }
+      end
+    end
+
+    # A store that keeps every result in its own file under a directory.
+    # It has no size limit; clean the directory up as needed.
+    class FileStore
+      # @return [String]
+      attr_reader :dir
+
+      # @param dir [String]
+      def initialize(dir)
+        @dir = dir
+      end
+
+      # @param key [String]
+      # @return [String, nil]
+      def read(key)
+        File.binread(path(key))
+      rescue Errno::ENOENT
+        nil
+      end
+
+      # @param key [String]
+      # @param value [String]
+      def write(key, value)
+        file = path(key)
+        FileUtils.mkdir_p(File.dirname(file))
+        # Write to a temporary file first so that readers never see a partial result.
+        tmp = "#{file}.#{Process.pid}.#{Thread.current.object_id}"
+        File.binwrite(tmp, value)
+        File.rename(tmp, file)
+      end
+
+      private
+
+      def path(key)
+        File.join(@dir, key[0, 2], key)
+      end
+    end
+
+    # @return [#read, #write]
+    attr_reader :store
+
+    # @param store [#read, #write]
+    # @param version [String, nil] Pygments version to key results by;
+    #   read from the Pygments sources when not given, and only asked from
+    #   Python if they can't be found
+    def initialize(store: MemoryStore.new, version: nil)
+      @store = store
+      @version = version
+      @mutex = Mutex.new
+      @hits = 0
+      @misses = 0
+    end
+
+    # Return the cached result for the code and options, or highlight it
+    # with the given block and cache the result.
+    #
+    # @param code [String]
+    # @param opts [Hash] options as passed to Pygments.highlight
+    # @yieldreturn [String] highlighted code
+    # @return [String]
+    def fetch(code, opts = {})
+      return yield if code.nil? || code.empty?
+
+      opts = normalize(opts)
+      key = key_for(code, opts)
+      res = @store.read(key)
+
+      if res.nil?
+        @mutex.synchronize { @misses += 1 }
+        res = yield
+        @store.write(key, res.b) unless res.nil?
+        res
+      else
+        @mutex.synchronize { @hits += 1 }
+        res.dup.force_encoding(opts['options']['outencoding'])
+      end
+    end
+
+    # @return [Hash] hit and miss counters
+    def stats
+      @mutex.synchronize do
+        total = @hits + @misses
+        {
+          hits: @hits,
+          misses: @misses,
+          hit_rate: total.zero? ? 0.0 : @hits.fdiv(total)
+        }
+      end
+    end
+
+    private
+
+    # @param code [String]
+    # @param opts [Hash]
+    # @return [String]
+    def key_for(code, opts)
+      digest = Digest::SHA256.new
+      digest << JSON.generate([version, opts])
+      digest << "\0"
+      digest << code.b
+      digest.hexdigest
+    end
+
+    def version
+      @version ||= Pygments.local_pygments_version || Pygments.pygments_version
+    end
+
+    # Stringify and sort keys, fill in defaults and drop options that don't
+    # affect the result, so that equivalent options share a cache key.
+    #
+    # @param opts [Hash]
+    # @return [Hash]
+    def normalize(opts)
+      opts = deep_stringify(opts).reject { |k, _| k == 'timeout' }
+      opts['options'] = { 'outencoding' => 'utf-8' }.merge(opts['options'] || {})
+      opts
+    end
+
+    def deep_stringify(value)
+      case value
+      when Hash
+        value.map { |k, v| [k.to_s, deep_stringify(v)] }.sort_by(&:first).to_h
+      when Array
+        value.map { |v| deep_stringify(v) }
+      else
+        value
+      end
+    end
+  end
+end
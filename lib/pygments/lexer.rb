@@ -1,5 +1,6 @@
 # frozen_string_literal: true
 
+require 'json'
 require 'singleton'
 
 module Pygments
@@ -76,6 +77,24 @@ module Pygments
       LexerCache.instance.extname_index[extname]
     end
 
+    # Public: Look up Lexer by file name, matching it against the glob
+    # patterns of all lexers the way Pygments does when no code is given.
+    #
+    # filename - A String file name or path.
+    #
+    # Examples
+    #
+    #  Lexer.find_by_filename('app/models/user.rb')
+    #  # => #<Lexer name="Ruby">
+    #  Lexer.find_by_filename('Rakefile')
+    #  # => #<Lexer name="Ruby">
+    #
+    # @param filename [String]
+    # @return [Lexer, nil]
+    def self.find_by_filename(filename)
+      LexerCache.instance.find_by_filename(filename)
+    end
+
     # Public: Look up Lexer by one of it's mime types.
     #
     # type - A mime type String.
@@ -124,6 +143,9 @@ module Pygments
 
     attr_reader(:raw_lexers)
 
+    # Lexer metadata generated from vendor/pygments-main by `rake vendor:lexers`.
+    INDEX_FILE = File.join(__dir__, 'lexers.json')
+
     def initialize
       @lexers = []
       @index = {}
@@ -131,10 +153,16 @@ module Pygments
       @alias_index = {}
       @extname_index = {}
       @mimetypes_index = {}
-      @raw_lexers = Pygments.lexers!
+      @filename_patterns = []
+
+      # Lexer priorities and class names only come with the index.
+      # Without it, priorities are 0 and names stand in for class names.
+      classes = {}
+      @raw_lexers = load_index(classes) || Pygments.lexers!
 
       @raw_lexers.each_value do |hash|
         lexer = Lexer.new(hash[:name], hash[:aliases], hash[:filenames], hash[:mimetypes])
+        priority, class_name = classes.fetch(lexer.name, [0, lexer.name])
 
         @lexers << lexer
 
@@ -146,6 +174,10 @@ module Pygments
         end
 
         lexer.filenames.each do |filename|
+          # Explicit file names rank above patterns, like in Pygments.
+          rating = filename.include?('*') ? priority : priority + 0.5
+          @filename_patterns << [filename, lexer, [rating, class_name]]
+
           extnames = []
 
           extname = File.extname(filename)
@@ -168,5 +200,51 @@ module Pygments
         end
       end
     end
+
+    # @param filename [String]
+    # @return [Lexer, nil]
+    def find_by_filename(filename)
+      # Ties are broken by class name, like in Pygments.
+      best = filename_matches(filename).max_by { |_, _, rating| rating }
+      best&.[](1)
+    end
+
+    # @param filename [String]
+    # @return [Array<Lexer>] all lexers with a pattern that matches the file name
+    def lexers_for_filename(filename)
+      filename_matches(filename).map { |_, lexer, _| lexer }.uniq
+    end
+
+    private
+
+    # @param filename [String]
+    # @return [Array(String, Lexer, Array(Numeric, String))]
+    def filename_matches(filename)
+      basename = File.basename(filename)
+      @filename_patterns.select { |pattern, _, _| File.fnmatch(pattern, basename, File::FNM_DOTMATCH) }
+    end
+
+    # Read lexers from INDEX_FILE unless it was generated for a different
+    # Pygments version than the one mentos is going to use.
+    #
+    # @param classes [Hash<String, Array(Numeric, String)>] filled with lexer
+    #   priorities and class names
+    # @return [Hash, nil] lexers in the format of Popen#lexers!
+    def load_index(classes)
+      return nil unless File.exist?(INDEX_FILE)
+
+      index = JSON.parse(File.read(INDEX_FILE))
+      return nil unless index['version'] == Pygments.local_pygments_version
+
+      index['lexers'].each_with_object({}) do |(name, aliases, filenames, mimetypes, priority, class_name), hash|
+        classes[name] = [priority, class_name]
+        hash[name] = {
+          name: name,
+          aliases: aliases,
+          filenames: filenames,
+          mimetypes: mimetypes
+        }
+      end
+    end
   end
 end
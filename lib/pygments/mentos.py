@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import socket
 import struct
 import sys, re, os, signal
+import threading
+import time
 import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 if 'PYGMENTS_PATH' in os.environ:
     sys.path.insert(0, os.environ['PYGMENTS_PATH'])
 
@@ -14,6 +20,7 @@ sys.path.append(base_dir + "/vendor/pygments-main")
 
 import pygments
 from pygments import lexers, formatters, styles, filters
+from pygments.util import ClassNotFound
 
 try:
     import json
@@ -26,14 +33,152 @@ def _convert_keys(dictionary):
     return dict((str(k), _convert_keys(v))
         for k, v in list(dictionary.items()))
 
-def _write_error(error):
+# Responses to pipelined requests are written from several threads.
+_stdout_lock = threading.Lock()
+
+class MentosError(Exception):
+    """
+    An error whose message is reported back to Ruby as is, without a traceback
+    """
+    pass
+
+# Timings of the request the current thread works on, if the client asked
+# for them with "timings": true.
+_timings = threading.local()
+
+@contextmanager
+def _timed(name):
+    """
+    Add the time spent in the block to the current request's timings.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(_timings, "current", None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def _timed_tokens(tokens, timings):
+    """
+    Pass tokens through, adding the time spent producing them to "lex".
+    """
+    tokens = iter(tokens)
+    while True:
+        start = time.perf_counter()
+        try:
+            token = next(tokens)
+        except StopIteration:
+            return
+        finally:
+            timings["lex"] = timings.get("lex", 0.0) + time.perf_counter() - start
+        yield token
+
+def _with_timings(header):
+    timings = getattr(_timings, "current", None)
+    if timings is not None:
+        header["timings"] = dict(timings, total=time.perf_counter() - _timings.started)
+    return header
+
+def _write_frame(header, body=b''):
+    out_header_bytes = json.dumps(header).encode('utf-8')
+    with _stdout_lock:
+        sys.stdout.buffer.write(struct.pack('!i', len(out_header_bytes)))
+        sys.stdout.buffer.write(out_header_bytes)
+        sys.stdout.buffer.write(body)
+        sys.stdout.flush()
+
+def _write_error(error, request_id=None):
     res = {"error": error}
-    out_header_bytes = json.dumps(res).encode('utf-8')
-    sys.stdout.buffer.write(struct.pack('!i', len(out_header_bytes)))
-    sys.stdout.buffer.write(out_header_bytes)
-    sys.stdout.flush()
+    if request_id is not None:
+        res["id"] = request_id
+    _write_frame(res)
     return
 
+def _read_chunks():
+    """
+    Read a body sent as a series of length-prefixed chunks, ending with an
+    empty chunk.
+    """
+    chunks = []
+    while True:
+        size = struct.unpack('!i', sys.stdin.buffer.read(4))[0]
+        if size == 0:
+            return b''.join(chunks)
+        chunks.append(sys.stdin.buffer.read(size))
+
+class _ChunkWriter(object):
+    """
+    A file-like object that sends whatever a formatter writes to it back to
+    Ruby in frames of about chunk_size bytes, marked with "more": true.
+    """
+    def __init__(self, method, request_id, chunk_size=64 * 1024):
+        self.header = {"method": method, "more": True}
+        if request_id is not None:
+            self.header["id"] = request_id
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.size:
+            body = b''.join(self.buffer)
+            _write_frame(dict(self.header, bytes=len(body)), body)
+            self.buffer = []
+            self.size = 0
+
+class _LRUCache(object):
+    """
+    A thread-safe, size-limited cache that evicts the least recently used
+    entries first and counts its hits and misses
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        """
+        Return the value cached for key, calling factory to build it on a miss.
+        """
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+
+        value = factory()
+        if self.maxsize <= 0:
+            return value
+
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses}
+
+def _cache_key(*parts):
+    # Options come from JSON, so they can be normalized by dumping them back.
+    return json.dumps(parts, sort_keys=True)
+
 def _signal_handler(signal, frame):
     """
     Handle the signal given in the first argument, exiting gracefully
@@ -45,7 +190,80 @@ class Mentos(object):
     Interacts with pygments.rb to provide access to pygments functionality
     """
     def __init__(self):
-        pass
+        size = int(os.environ.get('MENTOS_CACHE_SIZE', 128))
+        self.lexer_cache = _LRUCache(size)
+        self.formatter_cache = _LRUCache(size)
+        self.css_cache = _LRUCache(size)
+
+    def get_lexer(self, kind, name, inputs):
+        """
+        Return a new lexer found by name, mimetype or filename.
+
+        Only the lexer class is cached: lexers and formatters keep state
+        between calls, and requests run on several threads at once.
+        """
+        if kind == 'name':
+            name = name.lower()
+            factory = lambda: lexers.find_lexer_class_by_name(name)
+        elif kind == 'mimetype':
+            factory = lambda: type(lexers.get_lexer_for_mimetype(name))
+        else:
+            factory = lambda: self._lexer_class_for_filename(name)
+
+        lexer_class = self.lexer_cache.get(_cache_key(kind, name), factory)
+        return lexer_class(**(inputs or {}))
+
+    @staticmethod
+    def _lexer_class_for_filename(name):
+        lexer_class = lexers.find_lexer_class_for_filename(name)
+        if lexer_class is None:
+            raise ClassNotFound('no lexer for filename %r found' % name)
+        return lexer_class
+
+    def get_formatter(self, name, options):
+        """
+        Return a new formatter for the given name and options, with its class
+        cached.
+        """
+        name = str.lower(str(name))
+
+        def factory():
+            formatter_class = pygments.formatters.find_formatter_class(name)
+            if formatter_class is None:
+                raise ClassNotFound('no formatter found for name %r' % name)
+            return formatter_class
+
+        return self.formatter_cache.get(name, factory)(**options)
+
+    def css(self, formatter_name, klass, options):
+        """
+        Return the style definitions for a formatter, cached per arguments.
+        """
+        factory = lambda: pygments.formatters.get_formatter_by_name(formatter_name, **options).get_style_defs(klass)
+        return self.css_cache.get(_cache_key(formatter_name, klass, options), factory)
+
+    def preload(self, lexer_names, formatter_names):
+        """
+        Import and cache the given lexers and formatters ahead of the first
+        request.
+        """
+        options = {"outencoding": "utf-8"}
+        for name in lexer_names:
+            lexer = self.get_lexer('name', name, options)
+            # Lexing a little text makes sure the lexer is fully set up.
+            for _ in lexer.get_tokens("\n"):
+                pass
+
+        for name in formatter_names:
+            self.get_formatter(name, options)
+
+    def stats(self):
+        """
+        Return the sizes and hit/miss counters of the caches.
+        """
+        return {"lexers": self.lexer_cache.stats(),
+                "formatters": self.formatter_cache.stats(),
+                "css": self.css_cache.stats()}
 
     def return_lexer(self, lexer, args, inputs, code=None):
         """
@@ -66,17 +284,14 @@ class Mentos(object):
         """
 
         if lexer:
-            if inputs:
-                return lexers.get_lexer_by_name(lexer, **inputs)
-            else:
-                return lexers.get_lexer_by_name(lexer)
+            return self.get_lexer('name', lexer, inputs)
 
         if inputs:
             if 'lexer' in inputs:
-                return lexers.get_lexer_by_name(inputs['lexer'], **inputs)
+                return self.get_lexer('name', inputs['lexer'], inputs)
 
             elif 'mimetype' in inputs:
-                return lexers.get_lexer_for_mimetype(inputs['mimetype'], **inputs)
+                return self.get_lexer('mimetype', inputs['mimetype'], inputs)
 
             elif 'filename' in inputs:
                 name = inputs['filename']
@@ -86,7 +301,7 @@ class Mentos(object):
                 if code:
                     return lexers.guess_lexer_for_filename(name, code, **inputs)
                 else:
-                    return lexers.get_lexer_for_filename(name, **inputs)
+                    return self.get_lexer('filename', name, inputs)
 
         # If all we got is code, try anyway.
         if code:
@@ -110,19 +325,106 @@ class Mentos(object):
             _format_name = "html"
 
         # Return a lexer object
-        lexer = self.return_lexer(lexer, args, kwargs, code)
+        with _timed("lexer"):
+            lexer = self.return_lexer(lexer, args, kwargs, code)
 
         # Make sure we sucessfuly got a lexer
         if lexer:
-            formatter = pygments.formatters.get_formatter_by_name(str.lower(_format_name), **kwargs)
+            with _timed("formatter"):
+                formatter = self.get_formatter(_format_name, kwargs)
 
             # Do the damn thing.
-            res = pygments.highlight(code, lexer, formatter)
+            res = self._highlight(code, lexer, formatter)
 
             return res
 
         else:
-            _write_error("No lexer")
+            raise MentosError("No lexer")
+
+    def highlight_stream(self, code, lexer, kwargs, request_id=None):
+        """
+        Highlight the code, sending the output back in chunks while the
+        formatter produces it. The last frame is an empty one without "more".
+        """
+        formatter_name = kwargs.get("formatter", None) or "html"
+        opts = _convert_keys(kwargs.get("options", {}))
+
+        with _timed("lexer"):
+            lexer = self.return_lexer(lexer, [], opts, code)
+        if not lexer:
+            raise MentosError("No lexer")
+
+        with _timed("formatter"):
+            formatter = self.get_formatter(formatter_name, opts)
+        out = _ChunkWriter("highlight_stream", request_id)
+        self._highlight(code, lexer, formatter, out)
+        out.flush()
+
+        header = {"method": "highlight_stream", "bytes": 0}
+        if request_id is not None:
+            header["id"] = request_id
+        _write_frame(_with_timings(header))
+
+    def _highlight(self, code, lexer, formatter, outfile=None):
+        """
+        Lex and format code like pygments.highlight does. When timings are
+        asked for, the time spent producing tokens is counted as "lex" and
+        the rest as "format", while tokens still stream into the formatter.
+        """
+        timings = getattr(_timings, "current", None)
+        if timings is None:
+            return pygments.highlight(code, lexer, formatter, outfile)
+
+        lexed = timings.get("lex", 0.0)
+        start = time.perf_counter()
+        try:
+            return pygments.format(_timed_tokens(pygments.lex(code, lexer), timings), formatter, outfile)
+        finally:
+            lexing = timings.get("lex", 0.0) - lexed
+            timings["format"] = timings.get("format", 0.0) + time.perf_counter() - start - lexing
+
+    def highlight_batch(self, data, items):
+        """
+        Highlight several pieces of code sent in a single request.
+
+        The items argument is a list of [kwargs, bytes] pairs, one per piece
+        of code, in the order they appear in data. Every item is highlighted
+        independently, so a failure in one of them is reported as an error
+        for that item only instead of aborting the whole batch.
+        """
+        res = []
+        offset = 0
+
+        for item_kwargs, size in items:
+            chunk = data[offset:offset + size]
+            offset += size
+
+            try:
+                code = chunk.decode('utf-8')
+                lexer = item_kwargs.get("lexer", None)
+                if lexer:
+                    lexer = str(lexer)
+                formatter_name = item_kwargs.get("formatter", None) or "html"
+                opts = _convert_keys(item_kwargs.get("options", {}))
+
+                with _timed("lexer"):
+                    lexer = self.return_lexer(lexer, [], opts, code)
+                if not lexer:
+                    res.append({"error": "No lexer"})
+                    continue
+
+                with _timed("formatter"):
+                    formatter = self.get_formatter(formatter_name, opts)
+                out = self._highlight(code, lexer, formatter)
+                if type(out) is bytes:
+                    out = out.decode('utf-8')
+
+                res.append({"result": out})
+
+            except Exception:
+                res.append({"error": traceback.format_exc()})
+
+        return res
 
     def get_data(self, method, lexer, args, kwargs, text=None):
         """
@@ -158,10 +460,12 @@ class Mentos(object):
                 if type(res) is bytes:
                     res = res.decode('utf-8')
 
+            elif method == 'highlight_batch':
+                res = json.dumps(self.highlight_batch(text, args))
+
             elif method == 'css':
                 kwargs = _convert_keys(kwargs)
-                fmt = pygments.formatters.get_formatter_by_name(args[0], **kwargs)
-                res = fmt.get_style_defs(args[1])
+                res = self.css(args[0], args[1], kwargs)
 
             elif method == 'lexer_names_for':
                 lexer = self.return_lexer(None, args, kwargs, text)
@@ -171,32 +475,57 @@ class Mentos(object):
                     res = json.dumps(list(lexer.aliases))
 
                 else:
-                    _write_error("No lexer")
+                    raise MentosError("No lexer")
+
+            elif method == 'stats':
+                res = json.dumps(self.stats())
 
             elif method == 'version':
                 res = json.dumps([pygments.__version__])
 
             else:
-                _write_error("Invalid method " + method)
+                raise MentosError("Invalid method " + method)
 
             return res
 
 
-    def _send_data(self, res, method):
+    def _send_data(self, res, method, request_id=None):
         # Base header. We'll build on this, adding keys as necessary.
         base_header = {"method": method}
+        if request_id is not None:
+            base_header["id"] = request_id
 
-        res_bytes = res.encode("utf-8")
+        with _timed("encode"):
+            res_bytes = res.encode("utf-8")
         bytes = len(res_bytes)
         base_header["bytes"] = bytes
 
-        out_header_bytes = json.dumps(base_header).encode('utf-8')
-
         # Send it to Rubyland
-        sys.stdout.buffer.write(struct.pack('!i', len(out_header_bytes)))
-        sys.stdout.buffer.write(out_header_bytes)
-        sys.stdout.buffer.write(res_bytes)
-        sys.stdout.flush()
+        _write_frame(_with_timings(base_header), res_bytes)
+
+    def _handle_request(self, method, lexer, args, kwargs, text, request_id=None):
+        """
+        Run a single request and send back either its result or its error.
+        """
+        _timings.current = {} if kwargs.get("timings") else None
+        _timings.started = time.perf_counter()
+
+        try:
+            # Streamed results are sent as they are produced.
+            if method == 'highlight_stream':
+                self.highlight_stream(text, lexer, kwargs, request_id)
+                return
+
+            # Get the actual data from pygments.
+            res = self.get_data(method, lexer, args, kwargs, text)
+
+            self._send_data(res, method, request_id)
+
+        except MentosError as e:
+            _write_error(str(e), request_id)
+
+        except:
+            _write_error(traceback.format_exc(), request_id)
 
     def _parse_header(self, header):
         method = header["method"]
@@ -216,7 +545,21 @@ class Mentos(object):
 
         The header is of form:
         { "method": "highlight", "args": [], "kwargs": {"arg1": "v"}, "bytes": 128}
+
+        With "timings": true in kwargs, the response header reports the
+        seconds spent on building the lexer and formatter, lexing,
+        formatting, encoding and in total under "timings".
+
+        For highlight_stream, the text is sent as length-prefixed chunks
+        instead, and the result comes back in several frames.
+
+        If the header also carries an "id", the request is run on a thread pool
+        and the response header echoes that id, so clients may keep several
+        requests in flight and receive the answers out of order. Requests
+        without an id are answered one by one, in order.
         """
+        threads = int(os.environ.get('MENTOS_THREADS', 0)) or None
+        executor = ThreadPoolExecutor(max_workers=threads)
 
         while True:
             header_size_bytes = sys.stdin.buffer.read(4)
@@ -224,10 +567,12 @@ class Mentos(object):
                 break
 
             header_size = struct.unpack('!i', header_size_bytes)[0]
+            request_id = None
 
             try:
                 line = sys.stdin.buffer.read(header_size).decode('utf-8')
                 header = json.loads(line)
+                request_id = header.get("id", None)
 
                 method, args, kwargs, lexer = self._parse_header(header)
                 _bytes = 0
@@ -240,16 +585,69 @@ class Mentos(object):
                     _bytes = kwargs.get("bytes", 0)
 
                 # Read up to the given number of *bytes* (not chars) (possibly 0)
-                text = sys.stdin.buffer.read(_bytes).decode('utf-8')
+                text = sys.stdin.buffer.read(_bytes)
+
+                # Streamed code follows in chunks of its own.
+                if method == 'highlight_stream':
+                    text = _read_chunks()
 
-                # Get the actual data from pygments.
-                res = self.get_data(method, lexer, args, kwargs, text)
+                # Batches carry several payloads whose sizes are given in bytes,
+                # so they are split before decoding.
+                if method != 'highlight_batch':
+                    text = text.decode('utf-8')
 
-                self._send_data(res, method)
+                if request_id is None:
+                    self._handle_request(method, lexer, args, kwargs, text)
+                else:
+                    executor.submit(self._handle_request, method, lexer, args, kwargs, text, request_id)
 
             except:
                 tb = traceback.format_exc()
-                _write_error(tb)
+                _write_error(tb, request_id)
+
+        # Let pipelined requests finish before exiting.
+        executor.shutdown(wait=True)
+
+def _names(variable):
+    return [name for name in os.environ.get(variable, "").split(",") if name]
+
+def zygote(path):
+    """
+    Preload the lexers and formatters listed in MENTOS_PRELOAD_LEXERS and
+    MENTOS_PRELOAD_FORMATTERS, then listen on a Unix socket at path. Every
+    connection is served by a forked child that starts out warm: it sends its
+    pid as 4 bytes and then speaks the usual protocol over the socket.
+    """
+    mentos = Mentos()
+    mentos.preload(_names("MENTOS_PRELOAD_LEXERS"), _names("MENTOS_PRELOAD_FORMATTERS"))
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+
+    # Let the kernel reap children as they exit.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    # Tell Ruby we are ready to accept connections.
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+
+    while True:
+        conn, _ = server.accept()
+        pid = os.fork()
+        if pid == 0:
+            server.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os.dup2(conn.fileno(), 0)
+            os.dup2(conn.fileno(), 1)
+            conn.close()
+
+            sys.stdout.buffer.write(struct.pack('!i', os.getpid()))
+            sys.stdout.flush()
+            mentos.start()
+            os._exit(0)
+
+        conn.close()
 
 def main():
 
@@ -259,6 +657,10 @@ def main():
     if sys.platform != "win32":
         signal.signal(signal.SIGHUP, _signal_handler)
 
+    if len(sys.argv) == 3 and sys.argv[1] == "--zygote":
+        zygote(sys.argv[2])
+        return
+
     mentos = Mentos()
     mentos.start()
 
@@ -0,0 +1,177 @@
+# frozen_string_literal: true
+
+require 'etc'
+require 'logger'
+
+module Pygments
+  # A bounded pool of mentos processes shared by all threads.
+  #
+  # By default every Ruby thread gets its own Python process. With a pool,
+  # threads check out one of a fixed number of processes instead, which caps
+  # memory use while still spreading work across cores:
+  #
+  #   Pygments.engine = Pygments::Pool.new(size: 4, timeout: 5)
+  class Pool
+    # Methods that are run on a checked out Popen.
+    ENGINE_METHODS = %i[
+      formatters
+      lexers!
+      filters
+      styles
+      css
+      lexer_names_for
+      highlight
+      highlight_stream
+      highlight_many
+      pygments_version
+      stats
+    ].freeze
+
+    # @return [Integer] number of mentos processes in the pool
+    attr_reader :size
+    # @return [Numeric] seconds to wait for a free process
+    attr_reader :timeout
+
+    # @param size [Integer] number of mentos processes
+    # @param timeout [Numeric] seconds to wait for a free process before raising MentosError
+    # @param zygote [Zygote, nil] zygote to fork the processes from
+    def initialize(size: Etc.nprocessors, timeout: 5, zygote: nil)
+      raise ArgumentError, "Pool size must be positive, got #{size}" unless size.positive?
+
+      @size = size
+      @timeout = timeout
+      @log = Logger.new(ENV.fetch('MENTOS_LOG', File::NULL))
+      @log.level = Logger::INFO
+      @log.datetime_format = '%Y-%m-%d %H:%M '
+
+      @mutex = Mutex.new
+      @available = ConditionVariable.new
+      @workers = Array.new(size) { Popen.new(zygote: zygote) }
+      @idle = @workers.dup
+      @start_args = []
+
+      @checkouts = 0
+      @restarts = 0
+      @wait_time = 0.0
+      @max_wait_time = 0.0
+    end
+
+    ENGINE_METHODS.each do |method|
+      define_method(method) do |*args, &block|
+        with_worker { |worker| worker.public_send(method, *args, &block) }
+      end
+    end
+
+    # Start all idle processes, optionally with a custom Pygments path.
+    # The path is remembered and used whenever a process is restarted.
+    def start(*args)
+      @mutex.synchronize do
+        @start_args = args
+        @idle.each do |worker|
+          worker.stop 'Restarting pool'
+          worker.start(*args)
+        end
+      end
+    end
+
+    # Stop all processes in the pool.
+    # @param reason [String]
+    def stop(reason)
+      @workers.each { |worker| worker.stop(reason) }
+    end
+
+    # Check out a process for the duration of the block.
+    #
+    # Waits up to #timeout seconds for a free process and makes sure it is
+    # running before yielding it. A process that a request failed on, e.g.
+    # by timing out, is stopped, so that the next checkout starts a new one.
+    #
+    # @yieldparam worker [Popen]
+    def with_worker
+      worker = checkout
+      begin
+        yield worker
+      rescue MentosError => e
+        @log.warn "Restarting mentos process after a failed request: #{e}"
+        @mutex.synchronize { @restarts += 1 }
+        worker.stop 'Request failed'
+        raise
+      ensure
+        checkin(worker)
+      end
+    end
+
+    # @return [Hash] checkout counters and queue-wait times in seconds
+    def checkout_stats
+      @mutex.synchronize do
+        {
+          size: @size,
+          idle: @idle.size,
+          checkouts: @checkouts,
+          restarts: @restarts,
+          wait_time: @wait_time,
+          max_wait_time: @max_wait_time
+        }
+      end
+    end
+
+    private
+
+    # @return [Popen]
+    def checkout
+      started_at = now
+      waited = nil
+      worker = @mutex.synchronize do
+        while @idle.empty?
+          remaining = started_at + @timeout - now
+          raise MentosError, "Timeout waiting #{@timeout}s for a mentos process" unless remaining.positive?
+
+          @available.wait(@mutex, remaining)
+        end
+
+        waited = now - started_at
+        @checkouts += 1
+        @wait_time += waited
+        @max_wait_time = waited if waited > @max_wait_time
+        @log.info "Waited #{waited.round(6)}s for a mentos process" if waited.positive?
+
+        @idle.pop
+      end
+
+      begin
+        Pygments.instrument(:checkout, wait: waited, size: @size)
+        ensure_alive(worker)
+      rescue StandardError
+        checkin(worker)
+        raise
+      end
+
+      worker
+    end
+
+    # @param worker [Popen]
+    def checkin(worker)
+      @mutex.synchronize do
+        @idle.push(worker)
+        @available.signal
+      end
+    end
+
+    # Restart the process if it was started before but has died since.
+    # @param worker [Popen]
+    def ensure_alive(worker)
+      return if worker.alive?
+
+      unless worker.pid.nil?
+        @log.warn "Restarting dead mentos process #{worker.pid}"
+        @mutex.synchronize { @restarts += 1 }
+        worker.stop 'Process is dead'
+      end
+      worker.start(*@start_args)
+    end
+
+    def now
+      Process.clock_gettime(Process::CLOCK_MONOTONIC)
+    end
+  end
+end
@@ -1,5 +1,6 @@
 # frozen_string_literal: true
 
+require 'digest'
 require 'json'
 require 'open3'
 require 'logger'
@@ -13,6 +14,42 @@ end
 # Python process.
 module Pygments
   class Popen
+    # Size of the chunks that streamed code is sent in, in bytes.
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    # How many chunks of a streamed response are buffered for the block.
+    STREAM_QUEUE_SIZE = 16
+
+    # Seconds that other requests in flight get to finish on a process that
+    # is still busy with a timed out request, before it is stopped anyway.
+    TIMEOUT_GRACE = 5
+
+    # How much code a fast lexer guess looks at, in bytes.
+    GUESS_BYTES = 16 * 1024
+
+    # How much of the start and the end of code is searched for modelines.
+    MODELINE_BYTES = 4 * 1024
+
+    # How many lexer guesses are remembered.
+    GUESS_CACHE_SIZE = 1024
+
+    # Vim modelines, as recognized by Pygments.
+    VIM_MODELINE = /(?:vi|vim|ex)(?:[<=>]?\d*)?:.*?(?:ft|filetype|syn|syntax)=([^:\s]+)/.freeze
+    # Emacs modelines, e.g. `-*- mode: ruby -*-` or `-*- ruby -*-`.
+    EMACS_MODELINE = /-\*-\s*(?:.*?mode:\s*([^;\s]+)|([^:;\s]+)\s*-\*-)/.freeze
+
+    # @return [Zygote, nil] zygote to fork mentos from instead of starting it afresh
+    attr_reader :zygote
+
+    # @param zygote [Zygote, nil]
+    def initialize(zygote: nil)
+      @zygote = zygote
+      @mutex = Mutex.new
+      @write_mutex = Mutex.new
+      @next_id = 0
+      @guesses = {}
+    end
+
     # Get things started by opening a pipe to mentos (the freshmaker), a
     # Python process that talks to the Pygments library. We'll talk back and
     # forth across this pipe.
@@ -26,13 +63,27 @@ module Pygments
       # Make sure we kill off the child when we're done
       at_exit { stop 'Exiting' }
 
-      # A pipe to the mentos python process. #popen4 gives us
-      # the pid and three IO objects to write and read.
-      argv = [*python_binary, File.join(__dir__, 'mentos.py')]
-      @pid, @in, @out, @err = popen4(argv)
-      @in.binmode
-      @out.binmode
-      @log.info "Starting pid #{@pid} with python #{python_binary}."
+      if @zygote
+        # A socket to a warm mentos process forked by the zygote. Its stderr
+        # goes wherever the zygote's does.
+        @pid, @in = @zygote.connect(pygments_path)
+        @out = @in
+        @err = nil
+        @log.info "Starting pid #{@pid} forked from zygote #{@zygote.pid}."
+      else
+        # A pipe to the mentos python process. #popen4 gives us
+        # the pid and three IO objects to write and read.
+        argv = [*python_binary, File.join(__dir__, 'mentos.py')]
+        @pid, @in, @out, @err = popen4(argv)
+        @in.binmode
+        @out.binmode
+        @log.info "Starting pid #{@pid} with python #{python_binary}."
+      end
+
+      # Requests waiting for their response, by id. Each process gets its own
+      # table so that a reader of a killed process can't fail newer requests.
+      @pending = {}
+      @reader = start_reader(@out, @pending)
     end
 
     def python_binary
@@ -41,6 +92,9 @@ module Pygments
 
     attr_writer :python_binary
 
+    # @return [Integer, nil] pid of the mentos process, if started
+    attr_reader :pid
+
     # Stop the child process by issuing a kill -9.
     #
     # We then call waitpid() with the pid, which waits for that particular
@@ -59,10 +113,12 @@ module Pygments
         @log.info "Killing pid: #{@pid}. Reason: #{reason}"
         begin
           Process.kill('KILL', @pid)
-          Process.waitpid(@pid)
+          # Processes forked by a zygote are its children, not ours.
+          Process.waitpid(@pid) if @zygote.nil?
         rescue Errno::ESRCH, Errno::ECHILD => e
           @log.warn(e)
         end
+        @in.close if @zygote
       end
       @pid = nil
     end
@@ -93,6 +149,14 @@ module Pygments
       mentos(:version)[0]
     end
 
+    # Public: Returns sizes and hit/miss counters of the lexer, formatter
+    # and css caches inside mentos
+    #
+    # @return [Hash]
+    def stats
+      mentos(:stats)
+    end
+
     # Public: Get an array of available Pygments formatters
     #
     # @return [Array<String>] an array of formatters
@@ -143,6 +207,11 @@ module Pygments
       mentos(:css, ['html', klass], opts)
     end
 
+    # Guessing a lexer from code is slow, so guesses are remembered by a
+    # digest of the code. Pass `guess: :fast` to also resolve modelines,
+    # unambiguous file names and shebangs in Ruby, and to only let Pygments
+    # look at the first GUESS_BYTES of the code.
+    #
     # @return [[String], nil] aliases of a lexer.
     def lexer_names_for(*args)
       # Pop off the last arg if it's a hash, which becomes our opts
@@ -154,7 +223,36 @@ module Pygments
 
       code = (args.pop if args.last.is_a?(String))
 
-      mentos(:lexer_names_for, args, opts, code)
+      guess = opts.fetch(:guess, :full)
+      raise ArgumentError, "Unknown guess mode: #{guess.inspect}" unless %i[fast full].include?(guess)
+
+      opts = opts.reject { |k, _| k == :guess }
+
+      # Only code needs guessing, and not when the lexer is known anyway.
+      return mentos(:lexer_names_for, args, opts, code) if code.nil? || opts.key?(:lexer) || opts.key?(:mimetype)
+
+      if guess == :fast
+        lexer = fast_guess(code, opts[:filename])
+        return lexer.aliases.dup unless lexer.nil?
+
+        code = code.byteslice(0, GUESS_BYTES).scrub('') if code.bytesize > GUESS_BYTES
+      end
+
+      digest = Digest::SHA256.new
+      digest << JSON.generate([guess, args, opts.reject { |k, _| k == :timeout }])
+      digest << "\0"
+      digest << code.b
+      key = digest.hexdigest
+
+      names = @mutex.synchronize { @guesses[key] }
+      if names.nil?
+        names = mentos(:lexer_names_for, args, opts, code)
+        @mutex.synchronize do
+          @guesses[key] = names
+          @guesses.shift while @guesses.size > GUESS_CACHE_SIZE
+        end
+      end
+      names.dup
     end
 
     # Public: Highlight code.
@@ -182,6 +280,79 @@ module Pygments
       str
     end
 
+    # Public: Highlight code, streaming the result.
+    #
+    # Takes the code as a String or an IO to read it from, and the same
+    # options as #highlight plus :out, an IO to write highlighted code to.
+    # Chunks of highlighted code are also yielded to the block, if given,
+    # as soon as Python produces them, so neither side holds the whole result.
+    # Only STREAM_QUEUE_SIZE chunks are buffered: a slow block or :out holds
+    # up Python and every other request sharing this process until it
+    # catches up.
+    #
+    # Unlike #highlight, trailing whitespace is kept.
+    #
+    # Returns nil.
+    def highlight_stream(code, opts = {}, &block)
+      return if code.nil? || (code.is_a?(String) && code.empty?)
+
+      opts = opts.dup
+      out = opts.delete(:out)
+      opts[:options] = { outencoding: 'utf-8' }.merge(opts[:options] || {})
+      encoding = opts[:options][:outencoding]
+
+      mentos(:highlight_stream, nil, opts, code) do |chunk|
+        chunk.force_encoding(encoding)
+        out&.write(chunk)
+        block&.call(chunk)
+      end
+      nil
+    end
+
+    # Public: Highlight many pieces of code in a single round trip.
+    #
+    # Takes an array of [code, opts] pairs, where opts are the same as
+    # for #highlight, and an optional hash of batch-wide options
+    # (currently only :timeout).
+    #
+    # Returns an array with one entry per pair: the highlighted string, or
+    # a MentosError if that particular entry could not be highlighted.
+    def highlight_many(items, opts = {})
+      results = Array.new(items.size)
+      batch = []
+      codes = []
+
+      items.each_with_index do |(code, item_opts), i|
+        if code.nil? || code.empty?
+          results[i] = code
+          next
+        end
+
+        item_opts = (item_opts || {}).reject { |k, _| k == :timeout }
+        item_opts[:options] = { outencoding: 'utf-8' }.merge(item_opts[:options] || {})
+
+        batch << [i, item_opts]
+        codes << code
+      end
+
+      return results if batch.empty?
+
+      args = batch.zip(codes).map { |(_, item_opts), code| [item_opts, code.bytesize] }
+      res = mentos(:highlight_batch, args, opts, codes)
+
+      batch.zip(res).each do |(i, item_opts), item|
+        if item[:error].nil?
+          str = item[:result].rstrip
+          str.force_encoding(item_opts[:options][:outencoding])
+          results[i] = str
+        else
+          results[i] = MentosError.new(item[:error])
+        end
+      end
+
+      results
+    end
+
     private
 
     # @param argv [Array<String>]
@@ -220,8 +391,9 @@ module Pygments
 
     # @param timeout [Integer]
     # @param error_message [String]
+    # @param on_timeout [Proc] called by the watchdog when the timeout expires
     # @yield
-    def with_watchdog(timeout, error_message)
+    def with_watchdog(timeout, error_message, on_timeout)
       state_mutex = Mutex.new
       state = :alive
       wd_cleanup = ConditionVariable.new
@@ -232,7 +404,7 @@ module Pygments
                        wd_cleanup.wait(state_mutex, timeout) if state != :finished
                        if state != :finished
                          @log.error error_message
-                         stop error_message
+                         on_timeout.call
                          state = :timeout
                        end
                      end
@@ -256,66 +428,232 @@ module Pygments
     end
 
     # Our 'rpc'-ish request to mentos. Requires a method name, and then optional
-    # args, kwargs, code.
-    def mentos(method, args = [], kwargs = {}, code = nil)
-      # Open the pipe if necessary
-      start unless alive?
+    # args, kwargs, code. Code may also be an array of strings that are sent
+    # back to back as a single body.
+    #
+    # Every request carries an id, so several threads may have requests in
+    # flight on the same process; mentos answers them in any order.
+    #
+    # With a block, code is a String or an IO that is sent in chunks, and the
+    # chunks of the response are yielded as they arrive.
+    #
+    # Timings of every request are reported to Pygments.subscribe subscribers.
+    def mentos(method, args = [], kwargs = {}, code = nil, &block)
+      instrumenting = Pygments.instrumenting?
+      timings = {}
+      started_at = now
+
+      # Open the pipe if necessary. Errors are handled on the process the
+      # request went to, even if another thread has restarted it since.
+      id, response, pending, pid, err = @mutex.synchronize do
+        # A process that is still busy with a timed out request would stall
+        # this one too, so start a fresh one instead.
+        stop 'Replacing process busy with a timed out request' if @pid && @pid == @poisoned_pid
+        start unless alive?
+
+        @next_id += 1
+        # A streamed response can be larger than fits in memory, so a block
+        # that falls behind holds up the reader, and through the pipe Python.
+        @pending[@next_id] = block ? SizedQueue.new(STREAM_QUEUE_SIZE) : Queue.new
+        [@next_id, @pending[@next_id], @pending, @pid, @err]
+      end
+      timings[:start] = now - started_at
 
       # Add metadata to the header and generate it.
-      kwargs = kwargs.merge('bytes' => (code.nil? ? 0 : code.bytesize))
-      out_header = JSON.generate(method: method, args: args, kwargs: kwargs)
+      timed_at = now
+      kwargs = kwargs.merge('bytes' => block ? 0 : Array(code).sum(&:bytesize))
+      kwargs['timings'] = true if instrumenting
+      out_header = JSON.generate(id: id, method: method, args: args, kwargs: kwargs)
+      timings[:serialize] = now - timed_at
+
+      # A timed out request may still be running in Python, e.g. in a runaway
+      # lexer, so its process is poisoned and has to go. Other requests in
+      # flight on it get to finish first, for up to TIMEOUT_GRACE seconds.
+      timed_out = false
+      error = nil
+      error_message = "Timeout on a mentos #{method} call"
+      on_timeout = lambda do
+        timed_out = true
+        idle = @mutex.synchronize do
+          pending.delete(id)
+          @poisoned_pid = pid
+          pending.empty?
+        end
+        # Make room, as the block may have stopped taking chunks.
+        response.clear
+        response.push(MentosError.new(error_message))
+
+        if idle
+          stop_process pid, error_message
+        else
+          Thread.new do
+            sleep TIMEOUT_GRACE
+            stop_process pid, error_message
+          end
+        end
+      end
 
       begin
         timeout = get_timeout(kwargs.delete(:timeout))
-        res = with_watchdog(timeout, "Timeout on a mentos #{method} call") do
-          write_header(out_header, code)
-
-          # mentos will now return data to us. First it sends the header.
-          header_len_bytes = @out.read(4)
-          if header_len_bytes.nil?
-            raise Errno::EPIPE, %(Failed to read response from Python process on a mentos #{method} call)
+        header, res = with_watchdog(timeout, error_message, on_timeout) do
+          timed_at = now
+          write_header(out_header, block ? chunks(code) : code)
+          timings[:write] = now - timed_at
+
+          # mentos will now return data to us, possibly after answering other requests.
+          timed_at = now
+          result = loop do
+            result = response.pop
+            raise result if result.is_a?(Exception)
+            break result unless result[0][:more]
+
+            block.call(result[1])
           end
-
-          header_len = header_len_bytes.unpack1('N')
-          @log.info "Size in: #{header_len}"
-          header = @out.read(header_len)
-
-          # Now handle the header, any read any more data required.
-          handle_header_and_return(header)
+          timings[:response] = now - timed_at
+          result
         end
-
-        # Finally, return what we got.
-        return_result(res, method)
       rescue Errno::EPIPE => e
+        error = e
         begin
-          error_msg = @err.read
+          error_msg = err&.read
           @log.error "Error running Python script: #{error_msg}"
-          stop "Error running Python script: #{error_msg}"
+          stop_process pid, "Error running Python script: #{error_msg}"
           raise MentosError, %(#{e}: #{error_msg})
         rescue Errno::EPIPE
           @log.error e.to_s
-          stop e.to_s
+          stop_process pid, e.to_s
           raise e
         end
       rescue StandardError => e
+        error = e
         @log.error e.to_s
-        stop e.to_s
+        stop_process pid, e.to_s unless timed_out
         raise e
+      ensure
+        drained = @mutex.synchronize do
+          pending.delete(id)
+          @poisoned_pid == pid && pending.empty?
+        end
+        # Release the reader if it is blocked on chunks nobody will take.
+        response.clear
+        # The last request on a poisoned process is done, so it can go now.
+        stop_process pid, 'Stopping process busy with a timed out request' if drained
+
+        if instrumenting
+          Pygments.instrument(:mentos, method: method, pid: pid, **timings, total: now - started_at,
+                                       python: header&.[](:timings), error: error&.message || header&.[](:error))
+        end
+      end
+
+      # mentos did answer, so the process is fine even if this particular request failed.
+      res = handle_header_and_return(header, res)
+
+      # Finally, return what we got.
+      return_result(res, method)
+    end
+
+    # Find a lexer for code in Ruby, in the cases where the answer is clear:
+    # a file name that only one lexer matches or, without a file name, a
+    # modeline or a shebang naming a known lexer.
+    #
+    # @param code [String]
+    # @param filename [String, nil]
+    # @return [Lexer, nil]
+    def fast_guess(code, filename)
+      unless filename.nil?
+        lexers = LexerCache.instance.lexers_for_filename(filename)
+        return lexers.size == 1 ? lexers[0] : nil
+      end
+
+      head = code.byteslice(0, MODELINE_BYTES).scrub('').lines.first(5)
+      tail = code.byteslice([code.bytesize - MODELINE_BYTES, 0].max, MODELINE_BYTES).scrub('').lines.last(5)
+      lexer = modeline_lexer(head) || modeline_lexer(tail)
+      return lexer unless lexer.nil?
+
+      shebang_lexer(head[0])
+    end
+
+    # @param lines [Array<String>]
+    # @return [Lexer, nil]
+    def modeline_lexer(lines)
+      lines.each do |line|
+        line = line.scrub
+        m = line.match(VIM_MODELINE) || line.match(EMACS_MODELINE)
+        next if m.nil?
+
+        lexer = Lexer.find_by_alias(m.captures.compact[0].downcase)
+        return lexer unless lexer.nil?
+      end
+      nil
+    end
+
+    # @param line [String, nil]
+    # @return [Lexer, nil]
+    def shebang_lexer(line)
+      return nil unless line&.start_with?('#!')
+
+      words = line.scrub[2..].split
+      words.shift if File.basename(words[0].to_s) == 'env'
+      interpreter = File.basename(words.find { |word| !word.start_with?('-') }.to_s)
+
+      # python3.11 -> python3 -> python
+      loop do
+        lexer = Lexer.find_by_alias(interpreter)
+        return lexer unless lexer.nil?
+
+        shorter = interpreter.sub(/[\d.]\z/, '')
+        return nil if shorter == interpreter || shorter.empty?
+
+        interpreter = shorter
+      end
+    end
+
+    # Split code into length-prefixed chunks, ending with an empty one.
+    #
+    # @param code [String, IO]
+    # @return [Enumerator<String>]
+    def chunks(code)
+      Enumerator.new do |y|
+        if code.is_a?(String)
+          (0...code.bytesize).step(STREAM_CHUNK_SIZE) do |offset|
+            chunk = code.byteslice(offset, STREAM_CHUNK_SIZE)
+            y << [chunk.bytesize].pack('N') << chunk
+          end
+        else
+          while (chunk = code.read(STREAM_CHUNK_SIZE))
+            y << [chunk.bytesize].pack('N') << chunk.b
+          end
+        end
+        y << [0].pack('N')
       end
     end
 
     # @param header [String]
-    # @param code [String, nil]
+    # @param code [String, Enumerable<String>, nil]
     def write_header(header, code)
-      # Get the size of the header itself and write that.
-      @in.write([header.bytesize].pack('N'))
+      # Get the size of the header itself and write that, then the header.
       @log.info "Size out: #{header.bytesize}"
 
       # mentos is now waiting for the header, and, potentially, code.
-      @in.write(header)
+      @write_mutex.synchronize do
+        @in.write([header.bytesize].pack('N'))
+        @in.write(header)
+        code = [code] if code.is_a?(String)
+        code&.each { |c| @in.write(c) }
+        @in.flush
+      end
       @log.info "Out header: #{header}"
-      @in.write(code) unless code.nil?
-      @in.flush
+    end
+
+    def now
+      Process.clock_gettime(Process::CLOCK_MONOTONIC)
+    end
+
+    # Stop the process unless it has already been replaced by another one.
+    # @param pid [Integer, nil]
+    # @param reason [String]
+    def stop_process(pid, reason)
+      @mutex.synchronize { stop reason if @pid == pid }
     end
 
     # @param timeout [Integer, nil]
@@ -326,20 +664,72 @@ module Pygments
       Integer(ENV.fetch('MENTOS_TIMEOUT', 0))
     end
 
-    # Based on the header we receive, determine if we need
-    # to read more bytes, and read those bytes if necessary.
+    # Read responses off the pipe for as long as the process lives and hand
+    # each of them to the request with the same id. Once the pipe is closed,
+    # every request still waiting gets an Errno::EPIPE.
     #
-    # @param header [String, nil]
-    # @return [String, nil] either highlighted text or metadata.
-    def handle_header_and_return(header)
-      raise MentosError, 'No header received back.' if header.nil?
+    # @param out [IO]
+    # @param pending [Hash{Integer => Queue, SizedQueue}]
+    # @return [Thread]
+    def start_reader(out, pending)
+      reader = Thread.new do
+        loop do
+          # First, mentos sends the header.
+          header_len_bytes = out.read(4)
+          break if header_len_bytes.nil?
 
-      @log.info "In header: #{header}"
-      header = header_to_json(header)
-      bytes = header[:bytes]
+          header_len = header_len_bytes.unpack1('N')
+          @log.info "Size in: #{header_len}"
+          header = out.read(header_len)
+          break if header.nil?
 
-      # Read more bytes (the actual response body)
-      res = @out.read(bytes.to_i)
+          @log.info "In header: #{header}"
+          json = JSON.parse(header, symbolize_names: true)
+
+          if json[:error].nil?
+            # Read more bytes (the actual response body)
+            res = out.read(json[:bytes].to_i)
+            break if res.nil? || res.bytesize < json[:bytes].to_i
+          end
+
+          if json[:id].nil?
+            # An error that mentos could not attribute to a request.
+            fail_pending(pending, MentosError.new(json[:error]))
+          elsif json[:more]
+            # A chunk of a streamed response; more frames for this request follow.
+            @mutex.synchronize { pending[json[:id]] }&.push([json, res])
+          else
+            @mutex.synchronize { pending.delete(json[:id]) }&.push([json, res])
+          end
+        end
+      rescue IOError, SystemCallError, JSON::ParserError => e
+        @log.warn(e)
+      ensure
+        fail_pending(pending, Errno::EPIPE.new('Failed to read response from Python process'))
+      end
+      reader.report_on_exception = false
+      reader
+    end
+
+    # @param pending [Hash{Integer => Queue, SizedQueue}]
+    # @param error [Exception]
+    def fail_pending(pending, error)
+      waiting = @mutex.synchronize { pending.values.tap { pending.clear } }
+      waiting.each do |response|
+        response.clear
+        response.push(error)
+      end
+    end
+
+    # Based on the header we receive, check that the request succeeded and
+    # that we have got the body it announced.
+    #
+    # @param header [Hash, nil]
+    # @param res [String, nil]
+    # @return [String, nil] either highlighted text or metadata.
+    def handle_header_and_return(header, res)
+      raise MentosError, 'No header received back.' if header.nil?
+      raise MentosError, header[:error] unless header[:error].nil?
 
       if header[:method] == 'highlight' && res.nil?
         # Make sure we have a result back; else consider this an error.
@@ -351,19 +741,9 @@ module Pygments
 
     # @return Ruby objects for the methods that want them, text otherwise.
     def return_result(res, method)
-      res = JSON.parse(res, symbolize_names: true) unless %i[highlight css].include?(method)
+      res = JSON.parse(res, symbolize_names: true) unless %i[highlight highlight_stream css].include?(method)
       res = res.rstrip if res.instance_of?(String)
       res
     end
-
-    # Convert a text header into JSON for easy access.
-    # @param header [String]
-    # @return [JSON]
-    def header_to_json(header)
-      json = JSON.parse(header, symbolize_names: true)
-      raise MentosError, json[:error] unless json[:error].nil?
-
-      json
-    end
   end
 end
@@ -0,0 +1,126 @@
+# frozen_string_literal: true
+
+require 'fileutils'
+require 'logger'
+require 'socket'
+require 'tmpdir'
+
+module Pygments
+  # A preloaded mentos process that forks ready-to-use children.
+  #
+  # Starting mentos imports Pygments, and the first highlight with a lexer
+  # imports and compiles that lexer as well. A zygote pays these costs once,
+  # for the lexers and formatters you name, and then forks a warm child for
+  # every Popen that connects to it:
+  #
+  #   Pygments.zygote = Pygments::Zygote.new(lexers: %w[ruby python], formatters: %w[html])
+  #
+  # Forking requires a Unix-like platform.
+  class Zygote
+    # @return [Array<String>] names of lexers to preload
+    attr_reader :lexers
+    # @return [Array<String>] names of formatters to preload
+    attr_reader :formatters
+    # @return [Integer, nil] pid of the zygote process, if started
+    attr_reader :pid
+
+    # @param lexers [Array<String>]
+    # @param formatters [Array<String>]
+    def initialize(lexers: [], formatters: ['html'])
+      raise MentosError, 'Pygments::Zygote requires fork, which is not available on Windows' if Gem.win_platform?
+
+      @lexers = lexers
+      @formatters = formatters
+      @mutex = Mutex.new
+      @log = Logger.new(ENV.fetch('MENTOS_LOG', File::NULL))
+      @log.level = Logger::INFO
+      @log.datetime_format = '%Y-%m-%d %H:%M '
+    end
+
+    # Start the zygote and wait until it has preloaded everything.
+    def start(pygments_path = File.join(__dir__, '..', '..', 'vendor', 'pygments-main'))
+      stop 'Restarting zygote'
+      @mutex.synchronize { start_locked(pygments_path) }
+    end
+
+    # Fork a new mentos child, starting the zygote if necessary.
+    #
+    # @return [Array(Integer, UNIXSocket)] pid of the child and a socket to talk to it
+    def connect(*args)
+      path = @mutex.synchronize do
+        start_locked(*args) unless alive_locked?
+        @socket_path
+      end
+
+      socket = UNIXSocket.new(path)
+      socket.binmode
+      pid_bytes = socket.read(4)
+      raise MentosError, 'Failed to fork a mentos process from the zygote' if pid_bytes.nil?
+
+      pid = pid_bytes.unpack1('N')
+      @log.info "Forked pid #{pid} from zygote #{@pid}."
+      [pid, socket]
+    end
+
+    # Stop the zygote. Children that were already forked keep running.
+    # @param reason [String]
+    def stop(reason)
+      @mutex.synchronize do
+        unless @pid.nil?
+          @log.info "Killing zygote pid: #{@pid}. Reason: #{reason}"
+          begin
+            Process.kill('KILL', @pid)
+            Process.waitpid(@pid)
+          rescue Errno::ESRCH, Errno::ECHILD => e
+            @log.warn(e)
+          end
+          @io.close
+          FileUtils.rm_rf(File.dirname(@socket_path))
+        end
+        @pid = nil
+      end
+    end
+
+    # @return [Boolean] true if the zygote is alive.
+    def alive?
+      @mutex.synchronize { alive_locked? }
+    end
+
+    private
+
+    # Reap the zygote if it has died, so that the next connect starts a new one.
+    def alive_locked?
+      return false if @pid.nil?
+
+      begin
+        return true if Process.waitpid(@pid, Process::WNOHANG).nil?
+      rescue Errno::ECHILD => e
+        @log.warn(e)
+      end
+
+      @log.info "Zygote pid #{@pid} has died."
+      @io.close
+      FileUtils.rm_rf(File.dirname(@socket_path))
+      @pid = nil
+      false
+    end
+
+    def start_locked(pygments_path = File.join(__dir__, '..', '..', 'vendor', 'pygments-main'))
+      @socket_path = File.join(Dir.mktmpdir('pygments'), 'zygote.sock')
+      env = {
+        'PYGMENTS_PATH' => pygments_path,
+        'MENTOS_PRELOAD_LEXERS' => @lexers.join(','),
+        'MENTOS_PRELOAD_FORMATTERS' => @formatters.join(',')
+      }
+
+      # Make sure we kill off the zygote when we're done
+      at_exit { stop 'Exiting' }
+
+      @io = IO.popen([env, File.join(__dir__, 'mentos.py'), '--zygote', @socket_path], 'r')
+      @pid = @io.pid
+      raise MentosError, 'Failed to start the mentos zygote' unless @io.gets == "ready\n"
+
+      @log.info "Started zygote pid #{@pid}, preloaded lexers: #{@lexers.join(', ')}."
+    end
+  end
+end
@@ -1,6 +1,8 @@
 # frozen_string_literal: true
 
 require 'test/unit'
+require 'stringio'
+require 'tmpdir'
 require 'pygments'
 ENV['mentos-test'] = 'yes'
 
@@ -93,6 +95,72 @@ class PygmentsHighlightTest < Test::Unit::TestCase
     assert_match '>importr</span>', code
   end
 
+  def test_highlight_many
+    res = P.highlight_many([[RUBY_CODE, { lexer: 'rb' }], ['# ø', { lexer: 'py' }], ['', {}], [RUBY_CODE]])
+    assert_equal 4, res.size
+    assert_equal P.highlight(RUBY_CODE, lexer: 'rb'), res[0]
+    assert_match '# ø', res[1]
+    assert_equal Encoding::UTF_8, res[1].encoding
+    assert_equal '', res[2]
+    assert_match '<span class="ch">#!/usr/bin/ruby</span>', res[3]
+  end
+
+  def test_highlight_many_reports_per_item_errors
+    res = P.highlight_many([[RUBY_CODE, { lexer: 'nonexistent' }], [RUBY_CODE, { lexer: 'rb' }]])
+    assert_kind_of MentosError, res[0]
+    assert_match 'nonexistent', res[0].message
+    assert_match '<span class="ch">#!/usr/bin/ruby</span>', res[1]
+  end
+
+  def test_highlight_stream
+    chunks = []
+    assert_nil P.highlight_stream(TEST_CODE * 10, lexer: 'py') { |chunk| chunks << chunk }
+
+    assert_operator chunks.size, :>, 1
+    assert_equal Encoding::UTF_8, chunks[0].encoding
+    assert_equal P.highlight(TEST_CODE * 10, lexer: 'py'), chunks.join.rstrip
+  end
+
+  def test_highlight_stream_from_io_to_io
+    out = StringIO.new
+    P.highlight_stream(StringIO.new('# ø'), lexer: 'rb', out: out)
+    assert_equal P.highlight('# ø', lexer: 'rb'), out.string.force_encoding(Encoding::UTF_8).rstrip
+  end
+
+  def test_highlight_stream_raises_on_error
+    assert_raise MentosError do
+      P.highlight_stream(RUBY_CODE, lexer: 'nonexistent') { flunk 'Nothing should be yielded' }
+    end
+  end
+
+  def test_stats_count_cache_hits
+    popen = Pygments::Popen.new
+    2.times { popen.highlight(RUBY_CODE, lexer: 'rb', options: { linenos: true }) }
+    2.times { popen.css('.highlight') }
+    stats = popen.stats
+    assert_equal({ size: 1, maxsize: 128, hits: 1, misses: 1 }, stats[:lexers])
+    assert_equal({ size: 1, maxsize: 128, hits: 1, misses: 1 }, stats[:formatters])
+    assert_equal({ size: 1, maxsize: 128, hits: 1, misses: 1 }, stats[:css])
+  ensure
+    popen.stop 'Test finished'
+  end
+
+  def test_line_numbers_restart_with_each_request
+    code = "a = 1\nb = 2\n"
+    first = P.highlight(code, lexer: 'py', formatter: 'terminal', options: { linenos: true })
+    assert_equal first, P.highlight(code, lexer: 'py', formatter: 'terminal', options: { linenos: true })
+  end
+
+  def test_lexer_dialect_does_not_leak_into_later_requests
+    popen = Pygments::Popen.new
+    code = 'x := 1.0E5; y := 10H;'
+    before = popen.highlight(code, lexer: 'modula2')
+    popen.highlight("(*!m2r10*) #{code}", lexer: 'modula2')
+    assert_equal before, popen.highlight(code, lexer: 'modula2')
+  ensure
+    popen.stop 'Test finished'
+  end
+
   def test_version
     version_str = P.pygments_version
     # This will throw "Malformed version number string" ArgumentError if version_str is not a valid version string
@@ -110,6 +178,289 @@ class PygmentsHighlightTest < Test::Unit::TestCase
   end
 end
 
+class PygmentsPipeliningTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+  TEST_CODE = File.read(
+    File.join(__dir__, '..', 'lib', 'pygments', 'mentos.py')
+  )
+
+  def setup
+    @popen = Pygments::Popen.new
+  end
+
+  def teardown
+    @popen.stop 'Test finished'
+  end
+
+  def test_requests_from_many_threads_share_one_process
+    threads = 8.times.map do |i|
+      Thread.new { i.even? ? @popen.highlight(TEST_CODE, lexer: 'py') : @popen.pygments_version }
+    end
+    results = threads.map(&:value)
+
+    assert_match 'Main loop, waiting for inputs on stdin', results[0]
+    assert_equal [P.pygments_version], results.values_at(1, 3, 5, 7).uniq
+  end
+
+  def test_timeout_only_fails_its_own_request
+    @popen.styles
+    pid = @popen.pid
+    slow = Thread.new { @popen.highlight(TEST_CODE * 20, lexer: 'py', timeout: 0.001) }
+    other = Thread.new { @popen.highlight(TEST_CODE * 20, lexer: 'py') }
+
+    assert_raise(MentosError.new('Timeout on a mentos highlight call')) { slow.value }
+    assert_match 'Main loop, waiting for inputs on stdin', other.value
+    assert_includes @popen.styles, 'colorful'
+    assert_not_equal pid, @popen.pid
+  end
+
+  def test_timeout_stops_hung_process
+    omit 'SIGSTOP is not available on Windows' if Gem.win_platform?
+
+    @popen.styles
+    pid = @popen.pid
+    Process.kill('STOP', pid)
+    # Larger than a pipe buffer, so the write blocks too.
+    assert_raise MentosError.new('Timeout on a mentos highlight call') do
+      @popen.highlight(TEST_CODE * 20, lexer: 'py', timeout: 1)
+    end
+
+    assert_match 'foo', @popen.highlight(RUBY_CODE, lexer: 'rb')
+    assert_not_equal pid, @popen.pid
+  end
+
+  def test_abandoned_stream_does_not_block_other_requests
+    assert_raise(RuntimeError.new('Enough')) do
+      @popen.highlight_stream(TEST_CODE * 100, lexer: 'py') { raise 'Enough' }
+    end
+    assert_match 'foo', @popen.highlight(RUBY_CODE, lexer: 'rb')
+  end
+
+  def test_failed_request_keeps_process_running
+    @popen.styles
+    pid = @popen.pid
+    assert_raise MentosError.new('No lexer') do
+      @popen.lexer_names_for(invalid: true)
+    end
+    assert_equal pid, @popen.pid
+    assert_match 'foo', @popen.highlight(RUBY_CODE, lexer: 'rb')
+  end
+end
+
+class PygmentsPoolTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def setup
+    @pool = Pygments::Pool.new(size: 2, timeout: 1)
+  end
+
+  def teardown
+    @pool.stop 'Test finished'
+  end
+
+  def test_highlight_on_multi_threads
+    results = 8.times.map do
+      Thread.new { @pool.highlight(RUBY_CODE, lexer: 'rb') }
+    end.map(&:value)
+
+    assert_equal [P.highlight(RUBY_CODE, lexer: 'rb')], results.uniq
+    stats = @pool.checkout_stats
+    assert_equal 8, stats[:checkouts]
+    assert_equal 2, stats[:idle]
+  end
+
+  def test_restarts_dead_process
+    @pool.with_worker do |worker|
+      worker.start
+      Process.kill('KILL', worker.pid)
+      sleep 0.01 while worker.alive?
+    end
+
+    assert_match 'foo', @pool.highlight(RUBY_CODE, lexer: 'rb')
+    assert_equal 1, @pool.checkout_stats[:restarts]
+  end
+
+  def test_restarts_process_after_failed_request
+    assert_raise MentosError.new('Timeout on a mentos highlight call') do
+      @pool.highlight(RUBY_CODE * 10_000, lexer: 'rb', timeout: 0.001)
+    end
+
+    assert_equal 1, @pool.checkout_stats[:restarts]
+    assert_match 'foo', @pool.highlight(RUBY_CODE, lexer: 'rb')
+  end
+
+  def test_raises_on_checkout_timeout
+    pool = Pygments::Pool.new(size: 1, timeout: 0.01)
+    pool.with_worker do
+      assert_raise MentosError do
+        Thread.new { pool.styles }.join
+      end
+    end
+  ensure
+    pool.stop 'Test finished'
+  end
+
+  def test_rejects_empty_pool
+    assert_raise ArgumentError do
+      Pygments::Pool.new(size: 0)
+    end
+  end
+end
+
+class PygmentsZygoteTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def setup
+    omit 'Zygote requires fork' if Gem.win_platform?
+
+    @zygote = Pygments::Zygote.new(lexers: %w[ruby])
+  end
+
+  def teardown
+    @zygote&.stop 'Test finished'
+  end
+
+  def test_forked_process_starts_warm
+    popen = Pygments::Popen.new(zygote: @zygote)
+    assert_equal P.highlight(RUBY_CODE, lexer: 'ruby'), popen.highlight(RUBY_CODE, lexer: 'ruby')
+    assert_equal 1, popen.stats[:lexers][:hits]
+    assert popen.alive?
+
+    popen.stop 'Test finished'
+    assert !popen.alive?
+    assert @zygote.alive?
+  end
+
+  def test_pool_forks_from_zygote
+    pool = Pygments::Pool.new(size: 2, zygote: @zygote)
+    assert_match 'foo', pool.highlight(RUBY_CODE, lexer: 'rb')
+    assert @zygote.alive?
+  ensure
+    pool&.stop 'Test finished'
+  end
+
+  def test_dead_zygote_is_restarted
+    @zygote.start
+    pid = @zygote.pid
+    Process.kill('KILL', pid)
+    100.times { @zygote.alive? && sleep(0.01) }
+    assert !@zygote.alive?
+
+    popen = Pygments::Popen.new(zygote: @zygote)
+    assert_match 'foo', popen.highlight(RUBY_CODE, lexer: 'rb')
+    assert_not_equal pid, @zygote.pid
+    assert @zygote.alive?
+  ensure
+    popen&.stop 'Test finished'
+  end
+end
+
+class PygmentsCacheTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def teardown
+    P.cache = nil
+  end
+
+  def test_highlight_reuses_cached_result
+    P.cache = Pygments::Cache.new
+    expected = P.highlight(RUBY_CODE, lexer: 'rb')
+    code = P.highlight(RUBY_CODE, 'lexer' => :rb, timeout: 10)
+
+    assert_equal expected, code
+    assert_equal Encoding::UTF_8, code.encoding
+    assert_equal({ hits: 1, misses: 1, hit_rate: 0.5 }, P.cache.stats)
+    assert_not_equal expected, P.highlight(RUBY_CODE, lexer: 'rb', options: { linenos: true })
+  end
+
+  def test_warm_cache_does_not_start_python
+    popen = Pygments::Popen.new
+    cache = Pygments::Cache.new
+    cache.fetch(RUBY_CODE, lexer: 'rb') { 'highlighted' }
+
+    assert_equal 'highlighted', cache.fetch(RUBY_CODE, lexer: 'rb') { popen.highlight(RUBY_CODE, lexer: 'rb') }
+    assert !popen.alive?
+    assert_equal P.pygments_version, P.local_pygments_version
+  end
+
+  def test_memory_store_evicts_least_recently_used
+    store = Pygments::Cache::MemoryStore.new(max_bytes: 10)
+    store.write('a', 'aaaa')
+    store.write('b', 'bbbb')
+    store.read('a')
+    store.write('c', 'cccc')
+
+    assert_equal 'aaaa', store.read('a')
+    assert_nil store.read('b')
+    assert_equal 8, store.bytesize
+    assert_equal 2, store.size
+  end
+
+  def test_file_store
+    Dir.mktmpdir do |dir|
+      cache = Pygments::Cache.new(store: Pygments::Cache::FileStore.new(dir), version: 'test')
+      2.times { cache.fetch('x = 1', lexer: 'py') { 'highlighted' } }
+
+      assert_equal 1, cache.stats[:hits]
+      assert_equal 1, Dir.glob(File.join(dir, '*', '*')).size
+    end
+  end
+end
+
+class PygmentsInstrumentationTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def setup
+    @events = []
+    @subscriber = P.subscribe { |event, payload| @events << [event, payload] }
+  end
+
+  def teardown
+    P.unsubscribe(@subscriber)
+  end
+
+  def test_reports_request_timings
+    P.highlight(RUBY_CODE, lexer: 'rb')
+    event, payload = @events.last
+
+    assert_equal :mentos, event
+    assert_equal :highlight, payload[:method]
+    assert_nil payload[:error]
+    %i[start serialize write response total].each { |key| assert_kind_of Float, payload[key] }
+    %i[lexer formatter lex format encode total].each { |key| assert_kind_of Float, payload[:python][key] }
+  end
+
+  def test_reports_errors
+    assert_raise(MentosError) { P.highlight(RUBY_CODE, lexer: 'nonexistent') }
+    assert_match 'nonexistent', @events.last[1][:error]
+  end
+
+  def test_reports_success_inside_rescue
+    begin
+      raise 'unrelated'
+    rescue StandardError
+      P.highlight(RUBY_CODE, lexer: 'rb')
+    end
+    assert_nil @events.last[1][:error]
+  end
+
+  def test_reports_pool_checkouts
+    pool = Pygments::Pool.new(size: 1)
+    pool.styles
+    assert_equal %i[checkout mentos], @events.map(&:first)
+    assert_kind_of Float, @events[0][1][:wait]
+  ensure
+    pool.stop 'Test finished'
+  end
+
+  def test_unsubscribe
+    P.unsubscribe(@subscriber)
+    P.styles
+    assert_empty @events
+    assert !P.instrumenting?
+  end
+end
+
 class PygmentsLexerTest < Test::Unit::TestCase
   RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
 
@@ -137,6 +488,35 @@ class PygmentsLexerTest < Test::Unit::TestCase
     assert_includes P.lexer_names_for(RUBY_CODE), 'rb'
   end
 
+  def test_lexer_by_content_fast_guess
+    popen = Pygments::Popen.new
+    assert_includes popen.lexer_names_for(RUBY_CODE, guess: :fast), 'rb'
+    assert_equal 'python', popen.lexer_names_for("#!/usr/bin/env python3.11\nprint(1)", guess: :fast)[0]
+    assert_equal 'ruby', popen.lexer_names_for("# vim: set ft=ruby:\nputs 1", guess: :fast)[0]
+    assert_equal 'python', popen.lexer_names_for("#{"x = 1\n" * 100_000}# vim: ft=python", guess: :fast)[0]
+    assert_equal 'scala', popen.lexer_names_for('object A', filename: 'test.scala', guess: :fast)[0]
+    assert !popen.alive?, 'Python should not be needed'
+
+    assert_includes popen.lexer_names_for('int x;', filename: 'test.h', guess: :fast), 'c'
+    assert popen.alive?
+  ensure
+    popen.stop 'Test finished'
+  end
+
+  def test_lexer_by_content_is_remembered
+    popen = Pygments::Popen.new
+    names = popen.lexer_names_for(RUBY_CODE)
+    popen.stop 'Test finished'
+    assert_equal names, popen.lexer_names_for(RUBY_CODE)
+    assert !popen.alive?, 'Python should not be needed'
+  end
+
+  def test_lexer_by_content_unknown_guess_mode
+    assert_raise ArgumentError do
+      P.lexer_names_for(RUBY_CODE, guess: :maybe)
+    end
+  end
+
   def test_lexer_by_nothing
     assert_raise MentosError do
       P.lexer_name_for(invalid: true)
@@ -174,6 +554,23 @@ class PygmentsLexerClassTest < Test::Unit::TestCase
     assert_equal P::Lexer['Java'], P::Lexer.find_by_extname('.java')
   end
 
+  def test_find_lexer_by_filename
+    assert_equal P::Lexer['Ruby'], P::Lexer.find_by_filename('lib/pygments.rb')
+    assert_equal P::Lexer['Ruby'], P::Lexer.find_by_filename('Rakefile')
+    assert_equal P::Lexer['Bash'], P::Lexer.find_by_filename('.bashrc')
+    assert_equal P::Lexer['CMake'], P::Lexer.find_by_filename('CMakeLists.txt')
+    assert_equal P::Lexer['C'], P::Lexer.find_by_filename('test.h')
+    assert_equal P::Lexer['ActionScript'], P::Lexer.find_by_filename('test.as')
+    assert_equal P::Lexer['Prolog'], P::Lexer.find_by_filename('test.pl')
+    assert_equal P::Lexer['GAS'], P::Lexer.find_by_filename('test.s')
+    assert_nil P::Lexer.find_by_filename('test.unknown-extension')
+  end
+
+  def test_lexer_index_is_up_to_date
+    index = JSON.parse(File.read(P::LexerCache::INDEX_FILE))
+    assert_equal P.pygments_version, index['version'], 'Run `rake vendor:lexers`'
+  end
+
   def test_find_lexer_by_mimetype
     assert_equal P::Lexer['Ruby'], P::Lexer.find_by_mimetype('text/x-ruby')
     assert_equal P::Lexer['JSON'], P::Lexer.find_by_mimetype('application/json')